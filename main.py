@@ -1,11 +1,17 @@
 import asyncio
-import json
+import functools
+import os
 import re
+import secrets
 import shutil
+import string
 import tempfile
+import time
+import weakref
+import orjson
 from pathlib import Path
 from fastapi import FastAPI, HTTPException, Body
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.background import BackgroundTask
@@ -25,58 +31,203 @@ app.add_middleware(
 )
 
 # --- Configuration & Setup ---
-MAX_BYTES = 1 * 1024 * 1024 * 1024  # Hard size cap: 1 GiB
-YOUTUBE_RE = re.compile(r"^(https?://)?(www\.)?(youtube\.com|youtu\.be)/", re.IGNORECASE)
+# Hard size cap: 1 GiB. Enforced up front by SIZE_FILTER in every format selector, which makes
+# yt-dlp skip formats whose reported (or approximate) size is over the cap. The rest are
+# backstops: --max-filesize only fires after ~1 GiB is fetched (YouTube downloads in 10 MiB
+# chunks), and the byte counter in the video stream also covers merged video+audio totals.
+MAX_BYTES = 1 * 1024 * 1024 * 1024
+SIZE_FILTER = f"[filesize<?{MAX_BYTES}][filesize_approx<?{MAX_BYTES}]"
+MP3_SELECTOR = f"bestaudio{SIZE_FILTER}/best{SIZE_FILTER}"
+STREAM_CHUNK_SIZE = 64 * 1024  # Read size for piping yt-dlp stdout to the client
+SIZE_LABELS = ('B', 'KB', 'MB', 'GB', 'TB')
+PROC_EXIT_TIMEOUT = 30  # Seconds to wait for yt-dlp to exit once its stdout is exhausted
+# Every accepted "[http[s]://][www.](youtube.com|youtu.be)/" prefix, matched case-insensitively
+YOUTUBE_PREFIXES = tuple(
+    scheme + www + host
+    for scheme in ("", "http://", "https://")
+    for www in ("", "www.")
+    for host in ("youtube.com/", "youtu.be/")
+)
+YOUTUBE_PREFIX_LEN = max(map(len, YOUTUBE_PREFIXES))
+MAX_URL_LENGTH = 512
+_WS_RE = re.compile(r'\s+')
+_UNSAFE_RE = re.compile(r'[^A-Za-z0-9_.-]')
+_UNSAFE_TABLE = {c: None for c in range(128) if chr(c) not in string.ascii_letters + string.digits + '_.-'}
 TEMP_DIR = Path(tempfile.gettempdir()) / "video_downloader"
 TEMP_DIR.mkdir(exist_ok=True)
+# Binaries don't come and go at runtime, so resolve them once instead of per request
+YT_DLP_PATH = shutil.which("yt-dlp")
+FFMPEG_PATH = shutil.which("ffmpeg")
+YT_DLP_CMD = YT_DLP_PATH or "yt-dlp"
+# Shared prefix for every yt-dlp call; quiet mode skips progress output but still reports errors
+YT_DLP_BASE_CMD = [YT_DLP_CMD, "--no-playlist", "--no-warnings", "--quiet"]
+# Only the metadata fields /api/video_info reads, printed as two JSON lines
+META_TEMPLATE = "%(.{title,thumbnail})j"
+FORMATS_TEMPLATE = "%(formats.:.{acodec,vcodec,height,vbr,abr,filesize,filesize_approx}|[])j"
+TITLE_TEMPLATE = "%(title|video)s"
+META_CACHE_TTL = 10 * 60  # Seconds to reuse yt-dlp metadata for the same URL
+META_CACHE_MAX = 1024  # Most URLs kept in the metadata cache at once
+_meta_cache: dict[str, tuple[float, dict]] = {}
+_meta_inflight: dict[tuple[str, str], asyncio.Task] = {}  # Keyed by (url, "meta" | "title")
+# Bound concurrent yt-dlp processes; metadata lookups get their own pool so previews stay fast
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+MAX_CONCURRENT_META = int(os.getenv("MAX_CONCURRENT_META", "16"))
+_download_sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+_meta_sem = asyncio.Semaphore(MAX_CONCURRENT_META)
 
 
 # --- Helper Functions ---
+@functools.lru_cache(maxsize=2048)
 def is_youtube_url(url: str | None) -> bool:
-    return bool(url and YOUTUBE_RE.match(url.strip()))
+    if not url:
+        return False
+    if url[0].isspace():
+        url = url.lstrip()
+    return url[:YOUTUBE_PREFIX_LEN].lower().startswith(YOUTUBE_PREFIXES)
+
+def check_url(url: str | None, invalid_detail: str):
+    # Cheap sanity checks before any URL reaches a yt-dlp command line
+    if url and len(url) > MAX_URL_LENGTH:
+        raise HTTPException(status_code=400, detail="URL too long.")
+    if not is_youtube_url(url) or "\n" in url or "\r" in url or "\x00" in url:
+        raise HTTPException(status_code=400, detail=invalid_detail)
 
+@functools.lru_cache(maxsize=2048)
 def sanitize_filename(name: str) -> str:
-    name = re.sub(r'\s+', '_', name)
-    safe = re.sub(r'[^A-Za-z0-9_.-]', '', name).strip('_.-')
+    name = _WS_RE.sub('_', name)
+    # The table only covers ASCII, so non-ASCII titles still go through the regex
+    safe = name.translate(_UNSAFE_TABLE) if name.isascii() else _UNSAFE_RE.sub('', name)
+    safe = safe.strip('_.-')
     return safe or "download"
 
-def check_binary(name: str, install_hint: str):
-    if shutil.which(name) is None:
+def build_format_selector(format: str, quality: str) -> str:
+    height_selector = ""
+    if "p" in quality:
+        height = quality.replace("p", "")
+        height_selector = f"[height<={height}]"
+    # Every alternative carries SIZE_FILTER, so yt-dlp fails fast when nothing fits the cap
+    cap = SIZE_FILTER
+    if format == "mp4":
+        return f"bestvideo[vcodec^=avc1]{height_selector}{cap}+bestaudio[ext=m4a]{cap}/best[ext=mp4]{height_selector}{cap}/best{cap}"
+    return f"bestvideo[ext=webm]{height_selector}{cap}+bestaudio[ext=webm]{cap}/best[ext=webm]{height_selector}{cap}/best{cap}"
+
+# Selectors and height limits for the qualities offered in the UI, built once at import.
+QUALITY_HEIGHTS = {"best": 10000, "2160p": 2160, "1440p": 1440, "1080p": 1080, "720p": 720, "480p": 480, "360p": 360}
+MP4_SELECTORS = {q: build_format_selector("mp4", q) for q in QUALITY_HEIGHTS}
+WEBM_SELECTORS = {q: build_format_selector("webm", q) for q in QUALITY_HEIGHTS}
+
+def check_binary(path: str | None, name: str, install_hint: str):
+    if path is None:
         raise HTTPException(status_code=500, detail=f"{name} not found. {install_hint}")
 
-async def get_video_meta(url: str):
-    meta_cmd = ["yt-dlp", "--no-playlist", "--dump-json", url]
-    proc = await asyncio.create_subprocess_exec(
-        *meta_cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await proc.communicate()
+async def _run_meta_cmd(url: str, *templates: str) -> bytes:
+    meta_cmd = [*YT_DLP_BASE_CMD]
+    for template in templates:
+        meta_cmd += ["--print", template]
+    meta_cmd.append(url)
+    async with _meta_sem:
+        proc = await asyncio.create_subprocess_exec(
+            *meta_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
     stderr_output = stderr.decode(errors="ignore")
     if proc.returncode != 0:
         if "age-restricted" in stderr_output or "Sign in to confirm your age" in stderr_output:
              raise HTTPException(status_code=403, detail="This video is age-restricted and cannot be downloaded.")
         raise HTTPException(status_code=502, detail=f"yt-dlp metadata error: Could not fetch video details.")
+    return stdout
+
+async def _fetch_video_meta(url: str):
+    stdout = await _run_meta_cmd(url, META_TEMPLATE, FORMATS_TEMPLATE)
     try:
-        return json.loads(stdout)
-    except json.JSONDecodeError:
+        meta_line, formats_line = stdout.splitlines()
+        meta = orjson.loads(meta_line)
+        meta["formats"] = orjson.loads(formats_line)
+    except (ValueError, TypeError):
         raise HTTPException(status_code=502, detail="Could not parse video metadata.")
+    _cache_meta(url, meta)
+    return meta
+
+async def _fetch_video_title(url: str):
+    stdout = await _run_meta_cmd(url, TITLE_TEMPLATE)
+    return {"title": stdout.decode(errors="ignore").strip() or "video"}
+
+def _get_cached_meta(url: str) -> dict | None:
+    cached = _meta_cache.get(url)
+    if cached and time.monotonic() - cached[0] < META_CACHE_TTL:
+        return cached[1]
+    return None
+
+def _cache_meta(url: str, meta: dict):
+    now = time.monotonic()
+    _meta_cache.pop(url, None)
+    # Entries stay in insertion order, so expired or excess ones are always at the front
+    while _meta_cache:
+        oldest = next(iter(_meta_cache))
+        if len(_meta_cache) < META_CACHE_MAX and now - _meta_cache[oldest][0] < META_CACHE_TTL:
+            break
+        del _meta_cache[oldest]
+    _meta_cache[url] = (now, meta)
+
+def _finish_meta_fetch(key: tuple[str, str], task: asyncio.Task):
+    if _meta_inflight.get(key) is task:
+        del _meta_inflight[key]
+    # Marks a failure as retrieved even if every waiting request has gone away
+    if not task.cancelled():
+        task.exception()
+
+def _shared_fetch(key: tuple[str, str], fetch) -> asyncio.Task:
+    # Concurrent requests for the same key all await one task, so they get the same result or error
+    task = _meta_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch())
+        _meta_inflight[key] = task
+        task.add_done_callback(functools.partial(_finish_meta_fetch, key))
+    return task
+
+async def get_video_meta(url: str):
+    # Serve repeat lookups (preview then download) from cache
+    meta = _get_cached_meta(url)
+    if meta is not None:
+        return meta
+    task = _shared_fetch((url, "meta"), lambda: _fetch_video_meta(url))
+    # Shield so one client disconnecting doesn't cancel the fetch for everyone else
+    return await asyncio.shield(task)
+
+async def get_video_title(url: str) -> str:
+    # Downloads only need the title; reuse a preview's cached or in-flight metadata if there is one
+    meta = _get_cached_meta(url)
+    if meta is None:
+        task = _meta_inflight.get((url, "meta")) or _shared_fetch((url, "title"), lambda: _fetch_video_title(url))
+        meta = await asyncio.shield(task)
+    return meta.get("title", "video")
 
 def cleanup_file_sync(path: Path):
     try:
-        path.unlink(missing_ok=True)
-    except Exception as e:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
         print(f"Error cleaning up file {path}: {e}")
 
+def cleanup_leftovers_sync(output_path: Path):
+    # A failed or aborted yt-dlp run can leave .part files and intermediate audio next to the output
+    for leftover in output_path.parent.glob(f"{output_path.stem}*"):
+        cleanup_file_sync(leftover)
+
+def _release_download(proc: asyncio.subprocess.Process, stderr_task: asyncio.Task):
+    if proc.returncode is None:
+        proc.kill()
+    stderr_task.cancel()
+    _download_sem.release()
+
 def format_bytes(size: int | None) -> str:
     if size is None: return "N/A"
-    power = 1024
-    n = 0
-    power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
-    while size >= power and n < len(power_labels) -1 :
-        size /= power
-        n += 1
-    return f"{size:.2f} {power_labels[n]}"
+    # Each unit is 2**10 of the previous one, so the bit length picks the unit directly
+    n = min(max(int(size).bit_length() - 1, 0) // 10, len(SIZE_LABELS) - 1)
+    return f"{size / (1 << (10 * n)):.2f} {SIZE_LABELS[n]}"
 
 # --- API Endpoints ---
 @app.post("/api/video_info")
@@ -85,8 +236,7 @@ async def get_video_info(payload: dict = Body(...)):
     format_req = payload.get("format", "mp4")
     quality_req = payload.get("quality", "best")
 
-    if not is_youtube_url(url):
-        raise HTTPException(status_code=400, detail="Invalid YouTube URL.")
+    check_url(url, "Invalid YouTube URL.")
     
     try:
         print(f"--- 2. Fetching metadata for URL: {url} ---") # Add this
@@ -110,37 +260,42 @@ async def get_video_info(payload: dict = Body(...)):
     estimated_size = None
     formats = meta.get("formats", [])
 
+    height_req = QUALITY_HEIGHTS.get(quality_req)
+    if height_req is None:
+        height_req = int(quality_req.replace("p", "")) if format_req != "mp3" and "p" in quality_req else 10000
+
+    # Pick the best audio-only, video-only and combined streams in a single pass.
+    best_audio = best_video = best_combined = None
+    audio_key = video_key = combined_key = None
+    for f in formats:
+        vcodec = f.get('vcodec')
+        acodec = f.get('acodec')
+        if vcodec == 'none':
+            if acodec != 'none':
+                key = f.get('abr') or 0
+                if best_audio is None or key > audio_key:
+                    best_audio, audio_key = f, key
+            continue
+        height = f.get('height') or 0
+        if height > height_req:
+            continue
+        key = (height, f.get('vbr') or 0)
+        if acodec == 'none':
+            if best_video is None or key > video_key:
+                best_video, video_key = f, key
+        elif best_combined is None or key > combined_key:
+            best_combined, combined_key = f, key
+
     if format_req == "mp3":
-        audio_streams = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-        best_audio = max(audio_streams, key=lambda x: x.get('abr', 0), default=None)
         if best_audio:
             estimated_size = best_audio.get('filesize') or best_audio.get('filesize_approx')
     else: # Video formats
-        height_req = int(quality_req.replace("p", "")) if "p" in quality_req else 10000
-        
-        video_streams = [
-            f for f in formats 
-            if f.get('vcodec') != 'none' and f.get('acodec') == 'none' 
-            and (f.get('height') or 0) <= height_req
-        ]
-        best_video = max(video_streams, key=lambda x: (x.get('height', 0), x.get('vbr', 0)), default=None)
-        
-        audio_streams = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-        best_audio = max(audio_streams, key=lambda x: x.get('abr', 0), default=None)
-        
         if best_video and best_audio:
             size1 = best_video.get('filesize') or best_video.get('filesize_approx') or 0
             size2 = best_audio.get('filesize') or best_audio.get('filesize_approx') or 0
             estimated_size = size1 + size2
-        else:
-            combined_streams = [
-                f for f in formats 
-                if f.get('vcodec') != 'none' and f.get('acodec') != 'none' 
-                and (f.get('height') or 0) <= height_req
-            ]
-            best_combined = max(combined_streams, key=lambda x: (x.get('height', 0), x.get('vbr', 0)), default=None)
-            if best_combined:
-                estimated_size = best_combined.get('filesize') or best_combined.get('filesize_approx')
+        elif best_combined:
+            estimated_size = best_combined.get('filesize') or best_combined.get('filesize_approx')
 
     return {
         "title": title,
@@ -156,84 +311,122 @@ async def download_video(payload: dict = Body(...)):
     quality = payload.get("quality", "best")
     bitrate = payload.get("bitrate", "192")
 
-    if not is_youtube_url(url):
-        raise HTTPException(status_code=400, detail="Please provide a valid YouTube URL.")
+    check_url(url, "Please provide a valid YouTube URL.")
 
-    check_binary("yt-dlp", "Install with: pip install yt-dlp")
+    check_binary(YT_DLP_PATH, "yt-dlp", "Install with: pip install yt-dlp")
     if format == "mp3":
-        check_binary("ffmpeg", "Install ffmpeg and ensure it is in PATH")
+        check_binary(FFMPEG_PATH, "ffmpeg", "Install ffmpeg and ensure it is in PATH")
 
-    meta = await get_video_meta(url)
-    title = meta.get("title", "video")
+    title = await get_video_title(url)
     safe_title = sanitize_filename(title)
 
     if format == "mp3":
         filename = f"{safe_title}.mp3"
-        temp_filename = f"{safe_title}_{Path(tempfile.mktemp()).stem}.mp3"
+        temp_filename = f"{safe_title}_{secrets.token_hex(8)}.mp3"
         output_path = TEMP_DIR / temp_filename
-        dl_cmd = ["yt-dlp", "--no-playlist", "-x", "--audio-format", "mp3", "--audio-quality", f"{bitrate}K", "--embed-thumbnail", "--add-metadata", "-o", str(output_path), url]
-        proc = await asyncio.create_subprocess_exec(*dl_cmd, stderr=asyncio.subprocess.PIPE)
-        _, stderr = await proc.communicate()
+        dl_cmd = [*YT_DLP_BASE_CMD, "-x", "--audio-format", "mp3", "--audio-quality", f"{bitrate}K", "--embed-thumbnail", "--add-metadata", "-f", MP3_SELECTOR, "--max-filesize", str(MAX_BYTES), "-o", str(output_path), url]
+        async with _download_sem:
+            proc = await asyncio.create_subprocess_exec(*dl_cmd, stderr=asyncio.subprocess.PIPE)
+            _, stderr = await proc.communicate()
         if proc.returncode != 0 or not output_path.exists():
+            await asyncio.to_thread(cleanup_leftovers_sync, output_path)
             error_detail = stderr.decode(errors="ignore")
+            # No format passed SIZE_FILTER, or --max-filesize aborted (exits 0 without a file)
+            if proc.returncode == 0 or "Requested format is not available" in error_detail:
+                raise HTTPException(status_code=413, detail="This video is larger than the 1 GiB download limit.")
             if "age-restricted" in error_detail or "Sign in to confirm your age" in error_detail:
                 raise HTTPException(status_code=403, detail="This video is age-restricted and cannot be downloaded.")
             raise HTTPException(status_code=502, detail="Failed to create MP3 file.")
-        def stream_mp3():
-            with open(output_path, "rb") as f: yield from f
         cleanup_task = BackgroundTask(cleanup_file_sync, output_path)
-        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-        return StreamingResponse(stream_mp3(), media_type="audio/mpeg", headers=headers, background=cleanup_task)
+        return FileResponse(output_path, media_type="audio/mpeg", filename=filename, background=cleanup_task)
 
     ext = "mp4" if format == "mp4" else "webm"
     filename = f"{safe_title}-{quality}.{ext}" if quality != "best" else f"{safe_title}.{ext}"
-    height_selector = ""
-    if "p" in quality:
-        height = quality.replace("p", "")
-        height_selector = f"[height<={height}]"
-    if format == "mp4":
-        format_selector = f"bestvideo[vcodec^=avc1]{height_selector}+bestaudio[ext=m4a]/best[ext=mp4]{height_selector}/best"
-    else:
-        format_selector = f"bestvideo[ext=webm]{height_selector}+bestaudio[ext=webm]/best[ext=webm]{height_selector}/best"
-    dl_cmd = ["yt-dlp", "--no-playlist", "-f", format_selector, "-o", "-", url]
+    selectors = MP4_SELECTORS if format == "mp4" else WEBM_SELECTORS
+    format_selector = selectors.get(quality) or build_format_selector(format, quality)
+    dl_cmd = [*YT_DLP_BASE_CMD, "-f", format_selector, "--max-filesize", str(MAX_BYTES), "-o", "-", url]
     if format == "mp4":
         dl_cmd.extend(["--merge-output-format", "mp4"])
-    proc = await asyncio.create_subprocess_exec(
-        *dl_cmd, 
-        stdout=asyncio.subprocess.PIPE, 
-        stderr=asyncio.subprocess.PIPE
-    )
+
+    # Take the download slot and spawn yt-dlp before any headers go out, so a queued
+    # request waits here and a spawn failure becomes a proper error response.
+    await _download_sem.acquire()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *dl_cmd, 
+            stdout=asyncio.subprocess.PIPE, 
+            stderr=asyncio.subprocess.PIPE
+        )
+    except BaseException:
+        _download_sem.release()
+        raise
+    # Drain stderr in the background so yt-dlp never blocks on a full pipe
+    stderr_task = asyncio.create_task(proc.stderr.read())
+
+    # Wait for the first chunk so a download that produces nothing can still get an error status
+    try:
+        first_chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        if not first_chunk:
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=PROC_EXIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("yt-dlp did not exit after closing stdout, killing it.")
+                proc.kill()
+                await proc.wait()
+                raise HTTPException(status_code=502, detail="Failed to download video.")
+            stderr_output = (await stderr_task).decode(errors="ignore")
+    except BaseException:
+        _release_download(proc, stderr_task)
+        raise
+    if not first_chunk:
+        _release_download(proc, stderr_task)
+        # No format passed SIZE_FILTER, or --max-filesize skipped the file and exited cleanly
+        if proc.returncode == 0 or "Requested format is not available" in stderr_output:
+            raise HTTPException(status_code=413, detail="This video is larger than the 1 GiB download limit.")
+        if "age-restricted" in stderr_output or "Sign in to confirm your age" in stderr_output:
+            raise HTTPException(status_code=403, detail="This video is age-restricted and cannot be downloaded.")
+        raise HTTPException(status_code=502, detail="Failed to download video.")
 
     async def stream_content():
         total_bytes = 0
+        chunk = first_chunk
         try:
-            # Stream stdout chunk by chunk without waiting for the process to finish
-            async for chunk in proc.stdout:
+            # Stream stdout in fixed-size chunks as soon as yt-dlp produces them
+            while chunk:
                 total_bytes += len(chunk)
                 if total_bytes > MAX_BYTES:
                     print("File too large, stopping stream.")
                     proc.kill() # Terminate the process if the file is too big
                     break
                 yield chunk
+                chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
 
-            # Crucial: After streaming, await the process to get the return code 
-            # and check for errors that might have occurred during the download.
-            await proc.wait() 
+            # Headers are already sent, so errors past this point can only be logged.
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=PROC_EXIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("yt-dlp did not exit after closing stdout, killing it.")
+                proc.kill()
+                await proc.wait()
+            stderr_output = (await stderr_task).decode(errors="ignore")
             if proc.returncode != 0:
-                stderr_data = await proc.stderr.read()
-                stderr_output = stderr_data.decode(errors="ignore")
                 # This error often appears on stderr even on success, so we can ignore it.
                 if "does not start with a start code" not in stderr_output:
                      print(f"yt-dlp failed with return code {proc.returncode}: {stderr_output[-1000:]}")
-        
+
         finally:
             # Ensure the process is killed if it's still running for any reason
             if proc.returncode is None:
                 proc.kill()
             await proc.wait()
+            release_download()
 
+    body = stream_content()
+    # Runs once: from the generator's finally, or when the generator is garbage collected
+    # because the response was dropped before streaming ever started.
+    release_download = weakref.finalize(body, _release_download, proc, stderr_task)
     headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-    return StreamingResponse(stream_content(), media_type=f"video/{ext}", headers=headers)
+    return StreamingResponse(body, media_type=f"video/{ext}", headers=headers)
 
 # --- Mount static files (must be last) ---
 app.mount("/", StaticFiles(directory="static", html=True), name="static")